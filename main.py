@@ -2,12 +2,37 @@
 # Run this app with the command: streamlit run main.py
 
 import streamlit as st
+import streamlit.components.v1 as components
 import os
-from openai import AzureOpenAI
+from openai import APIConnectionError, APIError, APITimeoutError, AzureOpenAI, RateLimitError
 import re
+import regex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import dotenv
+import httpx
+import numpy as np
+import tiktoken
+from cachetools import TTLCache
+from lxml import etree
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+try:
+    from scour import scour  # Optional: stronger SVG optimization before prompting
+except ImportError:
+    scour = None
 
 dotenv.load_dotenv()  # Lädt Umgebungsvariablen aus der .env-Datei
+logger = logging.getLogger(__name__)
+# Streamlit leaves the root logger unconfigured (WARNING), so the app logs through its own handler.
+# The script reruns on every interaction, so the handler is only added once.
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
 # --- Configuration ---
 # Enter your Azure OpenAI credentials here.
 # It is recommended to use environment variables for better security.
@@ -15,11 +40,18 @@ dotenv.load_dotenv()  # Lädt Umgebungsvariablen aus der .env-Datei
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT", "YOUR_AZURE_OPENAI_ENDPOINT_URL")
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY", "YOUR_AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "YOUR_DEPLOYMENT_NAME")
-API_VERSION = "2024-02-01" # Current recommended API version
+# Optional smaller, faster deployment (e.g. gpt-4o-mini) for small SVGs; falls back to the main deployment
+AZURE_OPENAI_DEPLOYMENT_NAME_FAST = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME_FAST", AZURE_OPENAI_DEPLOYMENT_NAME)
+# Optional embedding deployment used to recognize near-duplicate animation requests;
+# the semantic cache is only active if it is set
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+API_VERSION = "2024-10-21" # Current GA version; reports cached prompt tokens and usage while streaming
 
 
 # --- System Prompt for the LLM (Improved for Creativity) ---
 # This prompt instructs the LLM on how to behave.
+# It is sent first and byte-identical with every request so that Azure's prompt caching can reuse it.
+# Never interpolate per-request data (inputs, timestamps, user IDs) into it.
 SYSTEM_PROMPT = """
 You are a creative and whimsical SVG animator, like the team that designed the famous Microsoft Office Assistant 'Clippy'. 
 Your goal is to bring static SVGs to life with personality, character, and complex, engaging animations. Don't just move elements; make them tell a small story.
@@ -44,21 +76,267 @@ Follow these rules strictly:
 7.  **CRITICAL VALIDATION:** Ensure every attribute has a valid, non-empty value. An attribute like `from=""` or `to=""` is invalid and MUST NOT be generated. Every animation attribute requires a specific value.
 """
 
+# --- User Prompt Template ---
+# Built once; per request only the fields are filled in. The SVG comes first: together with
+# the system prompt it forms the stable prefix that Azure caches across repeated requests
+# for the same graphic (from 1024 tokens on).
+_USER_PROMPT_TEMPLATE = (
+    "Here is the SVG code:\n---\n{svg}\n---\n\n"
+    "{path_refs}"
+    "Description of what the graphic shows:\n---\n{description}\n---\n\n"
+    "Animation instructions:\n---\n{animation}\n---\n"
+)
+_PATH_REFS_TEMPLATE = (
+    "Some d attributes are written as placeholders to keep this message short. "
+    "Keep them unchanged in your output:\n---\n{notes}\n---\n\n"
+)
+
+# --- Cleanup Patterns ---
+# Compiled once at import time; clean_svg_response runs after every LLM response.
+_FENCE_RE = re.compile(r'```(?:svg)?\s*(<svg.*?</svg>)\s*```', re.DOTALL | re.IGNORECASE)
+# Matches an attribute that is either empty (from="") or unquoted (transform=scale(2)), so both
+# repairs happen in one pass. It only starts at a token boundary and uses possessive quantifiers,
+# so it matches in linear time; backtracking forms took seconds on long runs of letters or spaces.
+_BROKEN_ATTR_RE = regex.compile(r'(?<!\s)(\s++)([a-zA-Z][\w\-:]*+)=(?:""|([^"\s>]++))')
+
+# --- Minification Patterns ---
+# Collapse the indentation and line breaks of exported SVGs before they are sent as prompt tokens.
+_INTER_TAG_WS_RE = re.compile(r'>\s+<')
+_REPEATED_WS_RE = re.compile(r'\s{2,}')
+# Significant digits scour keeps in coordinates and transforms (its default of 5 rounds e.g. 123.472)
+_SCOUR_DIGITS = 10
+
+# --- Path References ---
+# Repeated path data (e.g. two identical eyes) is sent once; later copies become @REFn placeholders.
+_PATH_REF_RE = re.compile(r'@REF\d+')
+_MIN_PATH_REF_LENGTH = 32
+
+# --- Display ---
+# Height of the preview iframe in pixels
+_PREVIEW_HEIGHT = 600
+
+# Seconds between two refreshes of the progress display while an animation is generated
+_JOB_POLL_INTERVAL = 0.25
+
+# --- Request Tuning ---
+# Animations generated at the same time in the background (shared by all sessions)
+_MAX_CONCURRENT_JOBS = 4
+
+# Threads that clean up finished variants while the others are still streaming (shared by all sessions)
+_CLEANUP_WORKERS = 4
+
+# Exact-match response cache: lifetime of an entry in seconds and maximum number of entries
+_RESPONSE_CACHE_TTL = 3600
+_RESPONSE_CACHE_SIZE = 256
+
+# Semantic cache: minimum cosine similarity for a hit and maximum number of entries per session
+_SEMANTIC_CACHE_THRESHOLD = 0.92
+_SEMANTIC_CACHE_SIZE = 128
+
+# Maximum number of animation variants generated in a single request
+_MAX_VARIANTS = 4
+
+# SVGs shorter than this (in characters, after minification) go to the fast deployment,
+# unless the instructions ask for path morphing
+_FAST_DEPLOYMENT_MAX_SVG_LENGTH = 300
+
+# Follow-up requests that ask the LLM to fix output that is not well-formed XML (per variant)
+_REPAIR_ATTEMPTS = 1
+
+# Completion token budget: the animated SVG repeats the input and adds animation tags,
+# so it is bounded by a multiple of the input plus some headroom, capped at the old fixed limit.
+_MAX_COMPLETION_TOKENS = 4000
+_COMPLETION_TOKENS_PER_INPUT_TOKEN = 1.5
+_COMPLETION_TOKENS_HEADROOM = 512
+# Rough characters per token of SVG code, used when the tokenizer is not available
+_CHARS_PER_TOKEN_ESTIMATE = 3
+
+# Retries of throttled or failed API calls: total attempts and longest wait in seconds
+_RETRY_ATTEMPTS = 3
+_RETRY_MAX_WAIT = 20
+_RETRY_BACKOFF = wait_exponential_jitter(initial=1, max=_RETRY_MAX_WAIT)
+
+# HTTP timeouts in seconds. The read timeout of a chat completion grows with the prompt,
+# because a longer prompt takes longer to process before the first token arrives.
+# It also limits the gap between two streamed chunks; _call_llm retries both cases.
+_CLIENT_TIMEOUT = httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0)
+_MIN_READ_TIMEOUT = 20
+_PROMPT_CHARS_PER_TIMEOUT_SECOND = 200
+
 # --- Helper Functions ---
 
+def _scour_options():
+    """
+    Returns scour options that shrink the SVG while keeping IDs, unreferenced definitions and
+    editor attributes (e.g. serif:id). scour still removes empty groups, see _scour_svg.
+    """
+    options = scour.sanitizeOptions()
+    options.strip_ids = False
+    options.shorten_ids = False
+    options.group_collapse = False
+    options.keep_defs = True
+    options.keep_editor_data = True
+    options.digits = _SCOUR_DIGITS
+    options.strip_xml_prolog = True
+    options.indent_type = 'none'
+    options.newlines = False
+    return options
+
+def _scour_svg(svg_text):
+    """
+    Optimizes the SVG code with scour, keeping the original path data.
+    Returns None if scour removed an element with an id (e.g. an empty group the description
+    refers to) or a path, or if the SVG is not well-formed.
+    """
+    scoured_text = scour.scourString(svg_text, _scour_options())
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=False)
+    try:
+        original = etree.fromstring(svg_text.encode('utf-8'), parser=parser)
+        scoured = etree.fromstring(scoured_text.encode('utf-8'), parser=parser)
+    except etree.XMLSyntaxError:
+        return None
+
+    original_ids = {element.get('id') for element in original.iter(etree.Element) if element.get('id')}
+    scoured_ids = {element.get('id') for element in scoured.iter(etree.Element) if element.get('id')}
+    original_paths = [element for element in original.iter(etree.Element) if element.get('d') is not None]
+    scoured_paths = [element for element in scoured.iter(etree.Element) if element.get('d') is not None]
+    if original_ids - scoured_ids or len(original_paths) != len(scoured_paths):
+        return None
+
+    # scour rewrites path data as relative shorthand commands, but path morphing
+    # starts from the absolute start and end points of the original path
+    for original_path, scoured_path in zip(original_paths, scoured_paths):
+        scoured_path.set('d', original_path.get('d'))
+    return etree.tostring(scoured, encoding='unicode')
+
+def _minify_svg(svg_text):
+    """
+    Reduces the SVG code to as few characters (and prompt tokens) as possible.
+    Uses scour if it is installed and keeps everything intact, then collapses the remaining whitespace.
+    """
+    if scour is not None:
+        try:
+            svg_text = _scour_svg(svg_text) or svg_text
+        except Exception:
+            pass # Invalid input is left to the whitespace pass and the LLM
+
+    svg_text = _INTER_TAG_WS_RE.sub('><', svg_text)
+    svg_text = _REPEATED_WS_RE.sub(' ', svg_text)
+    return svg_text.strip()
+
+def _nearest_id(element):
+    """
+    Returns the id of the element or of its closest ancestor that has one, or None.
+    """
+    while element is not None:
+        if element.get('id'):
+            return element.get('id')
+        element = element.getparent()
+    return None
+
+def _deduplicate_paths(svg_code):
+    """
+    Replaces repeated path data with short @REFn placeholders to save prompt tokens.
+    The first occurrence is kept; the SVG is returned unchanged if it isn't well-formed.
+
+    Returns:
+        tuple: The SVG code, and a dict mapping each placeholder to its path data and the
+        id of the element that holds the original (or None).
+    """
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=False)
+    try:
+        root = etree.fromstring(svg_code.encode('utf-8'), parser=parser)
+    except etree.XMLSyntaxError:
+        return svg_code, {}
+
+    first_elements = {}
+    refs = {}
+    for element in root.iter(etree.Element):
+        path_data = element.get('d')
+        if path_data is None or len(path_data) < _MIN_PATH_REF_LENGTH:
+            continue
+        if path_data not in first_elements:
+            first_elements[path_data] = element
+            continue
+        if path_data not in refs:
+            refs[path_data] = f"@REF{len(refs) + 1}"
+        element.set('d', refs[path_data])
+
+    if not refs:
+        return svg_code, {}
+    table = {ref: (path_data, _nearest_id(first_elements[path_data])) for path_data, ref in refs.items()}
+    return etree.tostring(root, encoding='unicode'), table
+
+def _path_ref_notes(path_refs):
+    """
+    Explains the @REFn placeholders to the LLM, one line per placeholder.
+    """
+    lines = []
+    for ref, (_, element_id) in path_refs.items():
+        origin = f'the path in the element with id="{element_id}"' if element_id else "an earlier path"
+        lines.append(f"{ref}: identical to the d attribute of {origin}")
+    return "\n".join(lines)
+
+def _expand_path_refs(svg_code, path_refs):
+    """
+    Replaces the @REFn placeholders in the LLM output with the original path data.
+    """
+    if not path_refs:
+        return svg_code
+    return _PATH_REF_RE.sub(lambda match: path_refs.get(match.group(0), (match.group(0),))[0], svg_code)
+
+def _drop_empty_attributes(svg_text):
+    """
+    Parses well-formed SVG code with lxml and removes empty attributes in a single pass.
+    Raises etree.XMLSyntaxError if the code is not well-formed.
+    """
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=False)
+    root = etree.fromstring(svg_text.encode('utf-8'), parser=parser)
+    for element in root.iter():
+        for name, value in list(element.attrib.items()):
+            if value == "":
+                del element.attrib[name]
+    return etree.tostring(root, encoding='unicode')
+
+def _repair_attribute(match):
+    """
+    Replacement for _BROKEN_ATTR_RE: drops empty attributes and quotes unquoted values.
+    """
+    whitespace, name, value = match.groups()
+    if value is None:
+        return ''
+    return f'{whitespace}{name}="{value}"'
+
+def _svg_error(svg_text):
+    """
+    Returns a description of the XML syntax error in the SVG code, or None if it is well-formed.
+    """
+    parser = etree.XMLParser(resolve_entities=False, huge_tree=False)
+    try:
+        etree.fromstring(svg_text.encode('utf-8'), parser=parser)
+    except etree.XMLSyntaxError as e:
+        return f"line {e.lineno}: {e.msg}"
+    return None
+
+def _is_valid_svg(svg_text):
+    """
+    Returns whether the LLM output is well-formed SVG code that can be shown and cached.
+    """
+    return svg_text.strip().startswith('<svg') and _svg_error(svg_text) is None
+
 def clean_svg_response(response_text):
     """
     Cleans the LLM response to ensure it's valid SVG code.
     1. Removes Markdown code fences.
     2. Removes non-breaking spaces.
-    3. Fixes unquoted attributes.
-    4. Removes empty attributes that cause validation errors.
+    3. Removes empty attributes that cause validation errors (via lxml).
+    4. Falls back to a single regex pass for malformed output (unquoted and empty attributes).
     """
     if not response_text:
         return ""
     
-    # 1. Remove Markdown fences
-    match = re.search(r'```(?:svg)?\s*(<svg.*?</svg>)\s*```', response_text, re.DOTALL | re.IGNORECASE)
+    # 1. Remove Markdown fences (the prompt forbids them, so first check cheaply whether there are any)
+    match = _FENCE_RE.search(response_text) if "```" in response_text else None
     if match:
         cleaned_text = match.group(1)
     else:
@@ -66,76 +344,444 @@ def clean_svg_response(response_text):
 
     # 2. Remove non-breaking spaces and strip whitespace
     cleaned_text = cleaned_text.replace('\xa0', ' ').strip()
-    
-    # 3. Fix unquoted attributes. Example: transform=scale(...) -> transform="scale(...)"
-    cleaned_text = re.sub(r'([a-zA-Z0-9\-:]+=)([^"\s>]+)', r'\1"\2"', cleaned_text)
 
-    # 4. Remove empty attributes that cause validation errors (e.g., from="", to="")
-    cleaned_text = re.sub(r'\s+([a-zA-Z0-9\-:]+)=""', '', cleaned_text)
+    # 3. Well-formed output: drop empty attributes (e.g., from="", to="") in one parse
+    try:
+        return _drop_empty_attributes(cleaned_text)
+    except etree.XMLSyntaxError:
+        pass
+
+    # 4. Malformed output: a recovering parser would silently discard the broken
+    #    elements, so repair the text instead. In one pass, fix unquoted attributes
+    #    (transform=scale(...) -> transform="scale(...)") and remove empty ones (from="", to="").
+    cleaned_text = _BROKEN_ATTR_RE.sub(_repair_attribute, cleaned_text)
 
     return cleaned_text
 
-def get_animated_svg(svg_code, description, animation_instructions):
+@st.cache_resource
+def _client():
     """
-    Calls the Azure OpenAI API to get the animated SVG.
+    Returns the Azure OpenAI client shared by all sessions.
+    Reusing it keeps the HTTP/2 connections (and their TLS sessions) alive between requests.
+    """
+    return AzureOpenAI(
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        api_key=AZURE_OPENAI_API_KEY,
+        api_version=API_VERSION,
+        timeout=_CLIENT_TIMEOUT,
+        max_retries=0, # Retries are handled by _call_llm
+        http_client=httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=10))
+    )
+
+@st.cache_resource
+def _encoder():
+    """
+    Returns the tokenizer used to estimate the size of the input SVG, or None if it can't be loaded.
+    tiktoken downloads the encoding on first use, which fails without network access.
+    """
+    try:
+        return tiktoken.encoding_for_model("gpt-4o")
+    except (KeyError, ValueError, OSError) as e:
+        logger.warning("Could not load the tokenizer, estimating tokens from the SVG length: %s", e)
+        return None
+
+def _completion_budget(svg_code, encoder):
+    """
+    Returns the max_tokens for a completion that animates the given SVG.
+    A tight bound lets Azure reserve less capacity per request.
+    """
+    if encoder is not None:
+        input_tokens = len(encoder.encode(svg_code))
+    else:
+        input_tokens = len(svg_code) // _CHARS_PER_TOKEN_ESTIMATE
+    budget = int(_COMPLETION_TOKENS_PER_INPUT_TOKEN * input_tokens + _COMPLETION_TOKENS_HEADROOM)
+    return min(_MAX_COMPLETION_TOKENS, budget)
+
+@st.cache_resource
+def _executor():
+    """
+    Returns the thread pool shared by all sessions for work that can overlap with network I/O.
+    """
+    return ThreadPoolExecutor(max_workers=_CLEANUP_WORKERS)
+
+@st.cache_resource
+def _job_executor():
+    """
+    Returns the thread pool that runs animation requests in the background, shared by all sessions.
+    Separate from _executor() so that a running request never waits for a pool it occupies itself.
+    """
+    return ThreadPoolExecutor(max_workers=_MAX_CONCURRENT_JOBS)
+
+@st.cache_resource
+def _response_cache():
+    """
+    Returns the process-wide cache of animated SVGs and the lock guarding it.
+    Entries are shared across sessions and keyed by the exact request inputs.
+    """
+    return TTLCache(maxsize=_RESPONSE_CACHE_SIZE, ttl=_RESPONSE_CACHE_TTL), threading.Lock()
+
+def _shared_resources():
+    """
+    Returns the shared objects an animation request needs.
+    Must be called on the script thread: the st.cache_resource factories expect its
+    ScriptRunContext, which background jobs don't have.
+    """
+    return {
+        "client": _client(),
+        "encoder": _encoder(),
+        "executor": _executor(),
+        "response_cache": _response_cache()
+    }
+
+def _embed_prompt(client, animation_instructions):
+    """
+    Returns the normalized embedding of the animation instructions.
+    The description is not embedded: it mostly stays the same while the instructions change,
+    and would pull different instructions together. It is part of the context key instead.
+    """
+    response = client.embeddings.create(
+        model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+        input=animation_instructions
+    )
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _semantic_cache_lookup(semantic_cache, context_key, vector):
+    """
+    Returns the SVG variants of the most similar earlier request in this session, or None.
+    Only entries with the same context (input SVG, description, variants, deployment, API version) are compared.
+    """
+    entries = [entry for entry in semantic_cache if entry[0] == context_key]
+    if not entries:
+        return None
+
+    # Vectors are normalized, so a single matrix product yields all cosine similarities
+    similarities = np.stack([entry[1] for entry in entries]) @ vector
+    best = int(np.argmax(similarities))
+    if similarities[best] >= _SEMANTIC_CACHE_THRESHOLD:
+        return entries[best][2]
+    return None
+
+def _semantic_cache_store(entry):
+    """
+    Remembers the animated SVG variants of an entry (context_key, vector, animated_svgs)
+    for later near-duplicate requests in this session.
+    """
+    entries = st.session_state.setdefault("semantic_cache", [])
+    entries.append(entry)
+    if len(entries) > _SEMANTIC_CACHE_SIZE:
+        del entries[0]
+
+def _retry_wait(retry_state):
+    """
+    Waits as long as the service asks for via its Retry-After header,
+    otherwise backs off exponentially with jitter.
+    """
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                return min(float(response.headers["retry-after-ms"]) / 1000, _RETRY_MAX_WAIT)
+            if "retry-after" in response.headers:
+                return min(float(response.headers["retry-after"]), _RETRY_MAX_WAIT)
+        except ValueError:
+            pass
+    return _RETRY_BACKOFF(retry_state)
+
+def _notify_retry(retry_state):
+    """
+    Reports that a transient API error is being retried, via the progress of the job (if any).
+    """
+    remaining = _RETRY_ATTEMPTS - retry_state.attempt_number
+    message = f"Azure OpenAI is busy, retrying in {retry_state.next_action.sleep:.0f}s ({remaining} attempts left)..."
+    logger.warning(message)
+    progress = retry_state.kwargs.get("progress")
+    if progress is not None:
+        progress["status"] = message
+
+    # The retried completion streams its tokens from the beginning again
+    preview = retry_state.kwargs.get("preview")
+    if preview is not None:
+        preview.clear()
+
+def _is_stream_error(exception):
+    """
+    Returns whether the exception is an error event sent in the middle of a stream.
+    openai raises those as a bare APIError; HTTP status errors are subclasses and are not retried.
+    """
+    return type(exception) is APIError
+
+@retry(
+    # Transport errors are raised unwrapped by the SDK once the stream has started
+    retry=(
+        retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, httpx.TimeoutException, httpx.TransportError))
+        | retry_if_exception(_is_stream_error)
+    ),
+    wait=_retry_wait,
+    stop=stop_after_attempt(_RETRY_ATTEMPTS),
+    before_sleep=_notify_retry,
+    reraise=True
+)
+def _call_llm(client, messages, model, variants, max_tokens, executor, progress=None, preview=None):
+    """
+    Streams a chat completion and returns the result of _read_stream. Opening and reading the
+    stream are retried together on rate limits, timeouts (also between two chunks), dropped
+    connections and error events in the stream.
+    The read timeout is derived from the prompt size; retries are reported to the progress dict.
+    """
+    prompt_length = sum(len(message["content"]) for message in messages)
+    read_timeout = max(_MIN_READ_TIMEOUT, prompt_length // _PROMPT_CHARS_PER_TIMEOUT_SECOND)
+    timeout = httpx.Timeout(
+        connect=_CLIENT_TIMEOUT.connect,
+        read=read_timeout,
+        write=_CLIENT_TIMEOUT.write,
+        pool=_CLIENT_TIMEOUT.pool
+    )
+    response = client.with_options(timeout=timeout).chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.6, # Increased temperature for more creativity
+        max_tokens=max_tokens,
+        n=variants,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    return _read_stream(response, variants, executor, preview)
+
+def _log_usage(usage):
+    """
+    Logs the token usage of a completion, including how much of the prompt was served from the cache.
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    logger.info(
+        "Prompt tokens: %d (cached: %d), completion tokens: %d",
+        usage.prompt_tokens, cached_tokens, usage.completion_tokens
+    )
+
+def _read_stream(response, variants, executor, preview=None):
+    """
+    Collects a streamed completion and returns the cleaned SVG code of each variant,
+    together with the finish reason of each (e.g. "length" if it hit max_tokens).
+    If a preview list is given, the tokens of the first variant are appended to it as they arrive.
+    """
+    bufs = [[] for _ in range(variants)]
+    cleanups = [None] * variants
+    finish_reasons = [None] * variants
+    for chunk in response:
+        # The final chunk carries only the token usage
+        if chunk.usage is not None:
+            _log_usage(chunk.usage)
+
+        # Content filter results from Azure arrive as chunks without choices and are skipped
+        for choice in chunk.choices:
+            buf = bufs[choice.index]
+            buf.append(choice.delta.content or "")
+            if preview is not None and choice.index == 0:
+                preview.append(choice.delta.content or "")
+
+            # Clean finished variants in the background while the others are still streaming
+            if choice.finish_reason is not None:
+                finish_reasons[choice.index] = choice.finish_reason
+                cleanups[choice.index] = executor.submit(clean_svg_response, "".join(buf))
+
+    animated_svgs = [
+        cleanup.result() if cleanup is not None else clean_svg_response("".join(buf))
+        for cleanup, buf in zip(cleanups, bufs)
+    ]
+    return animated_svgs, finish_reasons
+
+def _request_animation(resources, svg_code, description, animation_instructions, model, variants=1, progress=None):
+    """
+    Streams a completion from the Azure OpenAI API and returns the cleaned SVG variants.
+    All variants are generated server-side in one request (n=variants); variants that are
+    not well-formed XML are sent back to the LLM for repair. A reply that was cut off at the
+    token limit is repaired with the full budget, or left as it is if it already had it.
+    Raises the client's exception if the request fails.
 
     Args:
-        svg_code (str): The original SVG code.
+        resources (dict): The shared objects from _shared_resources().
+        svg_code (str): The cleaned input SVG code.
         description (str): Description of the static SVG.
         animation_instructions (str): Instructions for the animation.
+        model (str): Name of the Azure OpenAI deployment.
+        variants (int): Number of alternative animations to generate.
+        progress (dict): Optional job progress; receives the streamed first variant ("preview")
+            and retry messages ("status").
 
     Returns:
-        str: The animated SVG code, or an error message.
+        list[str]: The animated SVG code of each variant.
     """
-    # Clean the input SVG code of problematic characters
-    cleaned_svg_code = svg_code.replace('\xa0', ' ')
+    svg_code, path_refs = _deduplicate_paths(svg_code)
+    user_prompt = _USER_PROMPT_TEMPLATE.format_map({
+        "svg": svg_code,
+        "path_refs": _PATH_REFS_TEMPLATE.format_map({"notes": _path_ref_notes(path_refs)}) if path_refs else "",
+        "description": description,
+        "animation": animation_instructions
+    })
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+    client = resources["client"]
+    max_tokens = _completion_budget(svg_code, resources["encoder"])
+    animated_svgs, finish_reasons = _call_llm(
+        client, messages, model, variants, max_tokens, resources["executor"],
+        progress=progress, preview=progress["preview"] if progress is not None else None
+    )
+
+    # Ask for a corrected version of variants that are still not well-formed XML
+    for index, animated_svg in enumerate(animated_svgs):
+        finish_reason = finish_reasons[index]
+        repair_tokens = max_tokens
+        for _ in range(_REPAIR_ATTEMPTS):
+            error = _svg_error(animated_svg) if animated_svg else None
+            if error is None:
+                break
+            # A reply cut off at the token limit would be cut off again with the same budget
+            if finish_reason == "length":
+                if repair_tokens >= _MAX_COMPLETION_TOKENS:
+                    break
+                repair_tokens = _MAX_COMPLETION_TOKENS
+            repair_messages = messages + [
+                {"role": "assistant", "content": animated_svg},
+                {"role": "user", "content": f"Previous output had XML error at {error}. Return corrected SVG only."}
+            ]
+            if progress is not None:
+                progress["status"] = "Repairing an invalid SVG..."
+            repaired_svgs, repair_reasons = _call_llm(
+                client, repair_messages, model, 1, repair_tokens, resources["executor"], progress=progress
+            )
+            animated_svg, finish_reason = repaired_svgs[0], repair_reasons[0]
+        animated_svgs[index] = animated_svg
+
+    return [_expand_path_refs(animated_svg, path_refs) for animated_svg in animated_svgs]
 
-    if not all([AZURE_OPENAI_ENDPOINT != "YOUR_AZURE_OPENAI_ENDPOINT_URL",
+def _credentials_configured():
+    """
+    Returns whether the Azure OpenAI credentials have been set.
+    """
+    return all([AZURE_OPENAI_ENDPOINT != "YOUR_AZURE_OPENAI_ENDPOINT_URL",
                 AZURE_OPENAI_API_KEY != "YOUR_AZURE_OPENAI_API_KEY",
-                AZURE_OPENAI_DEPLOYMENT_NAME != "YOUR_DEPLOYMENT_NAME"]):
-        st.error("Error: Azure OpenAI credentials are not configured. Please set the variables in the code or use environment variables.")
-        return None
+                AZURE_OPENAI_DEPLOYMENT_NAME != "YOUR_DEPLOYMENT_NAME"])
 
-    try:
-        client = AzureOpenAI(
-            azure_endpoint=AZURE_OPENAI_ENDPOINT,
-            api_key=AZURE_OPENAI_API_KEY,
-            api_version=API_VERSION
-        )
+def _select_deployment(svg_code, animation_instructions):
+    """
+    Returns the deployment for a request: the fast one for small SVGs without path morphing,
+    otherwise the main one.
+    """
+    if len(svg_code) < _FAST_DEPLOYMENT_MAX_SVG_LENGTH and "morph" not in animation_instructions.lower():
+        return AZURE_OPENAI_DEPLOYMENT_NAME_FAST
+    return AZURE_OPENAI_DEPLOYMENT_NAME
 
-        user_prompt = f"""
-        Here is the SVG code:
-        ---
-        {cleaned_svg_code}
-        ---
-
-        Description of what the graphic shows:
-        ---
-        {description}
-        ---
-
-        Animation instructions:
-        ---
-        {animation_instructions}
-        ---
-        """
-
-        response = client.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT_NAME,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.6, # Increased temperature for more creativity
-            max_tokens=4000
-        )
+def get_animated_svg(resources, svg_code, description, animation_instructions, variants=1, semantic_cache=(), progress=None):
+    """
+    Calls the Azure OpenAI API to get the animated SVG.
+    Identical requests are answered from a shared cache without calling the API,
+    near-duplicate instructions for the same SVG from the session's semantic cache.
+    Makes no Streamlit calls, so it can run in a background thread; API errors are raised.
 
-        animated_svg = response.choices[0].message.content
-        return clean_svg_response(animated_svg)
+    Args:
+        resources (dict): The shared objects from _shared_resources().
+        svg_code (str): The original SVG code.
+        description (str): Description of the static SVG.
+        animation_instructions (str): Instructions for the animation.
+        variants (int): Number of alternative animations to generate.
+        semantic_cache (list): The session's semantic cache entries.
+        progress (dict): Optional job progress, see _request_animation.
 
-    except Exception as e:
-        st.error(f"An error occurred with the API request: {e}")
-        return None
+    Returns:
+        tuple: The valid animated SVG code of each variant, the output of the variants that
+        are not valid SVG, and the new semantic cache entry (None if the result came from
+        a cache or no embedding is available).
+    """
+    # Clean the input SVG code of problematic characters and strip formatting whitespace
+    cleaned_svg_code = _minify_svg(svg_code.replace('\xa0', ' '))
+
+    deployment = _select_deployment(cleaned_svg_code, animation_instructions)
+
+    # The deployment and API version are part of the key so that a model change never serves stale results
+    cache_key = (cleaned_svg_code, description, animation_instructions, variants, deployment, API_VERSION)
+    cache, cache_lock = resources["response_cache"]
+    with cache_lock:
+        cached_svgs = cache.get(cache_key)
+    if cached_svgs is not None:
+        return list(cached_svgs), [], None
+
+    client = resources["client"]
+
+    # The semantic cache is an optimization only; without an embedding we simply call the chat API
+    context_key = hash((cleaned_svg_code, description, variants, deployment, API_VERSION))
+    vector = None
+    if AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+        try:
+            vector = _embed_prompt(client, animation_instructions)
+        except APIError as e:
+            logger.warning("Embedding request failed, skipping the semantic cache: %s", e)
+    if vector is not None:
+        similar_svgs = _semantic_cache_lookup(semantic_cache, context_key, vector)
+        if similar_svgs is not None:
+            return list(similar_svgs), [], None
+
+    animated_svgs = _request_animation(
+        resources, cleaned_svg_code, description, animation_instructions,
+        deployment, variants=variants, progress=progress
+    )
+
+    # Check the results before they reach the browser, where broken XML fails silently.
+    # Invalid output is never cached, so that retrying the same inputs calls the API again.
+    valid_svgs, rejected_svgs = [], []
+    for animated_svg in animated_svgs:
+        (valid_svgs if _is_valid_svg(animated_svg) else rejected_svgs).append(animated_svg)
+
+    semantic_entry = None
+    if valid_svgs:
+        with cache_lock:
+            cache[cache_key] = tuple(valid_svgs)
+        if vector is not None:
+            semantic_entry = (context_key, vector, tuple(valid_svgs))
+    return valid_svgs, rejected_svgs, semantic_entry
+
+def _start_job(svg_code, description, animation_instructions, variants):
+    """
+    Starts generating the animation in the background and returns the job.
+    The job dict holds the future, the streamed preview and a status message for the UI.
+    """
+    job = {"preview": [], "status": "The AI is getting creative and bringing your SVG to life..."}
+    job["future"] = _job_executor().submit(
+        get_animated_svg, _shared_resources(), svg_code, description, animation_instructions, variants,
+        semantic_cache=list(st.session_state.get("semantic_cache", [])), progress=job
+    )
+    return job
+
+@st.fragment(run_every=_JOB_POLL_INTERVAL)
+def _show_job_progress(job):
+    """
+    Shows the status and the streamed code of a running job, refreshed while the rest of the app stays usable.
+    Reruns the whole app once the job is done so that the result is displayed.
+    """
+    if job["future"].done():
+        st.rerun()
+    preview = "".join(job["preview"])
+    with st.status(job["status"], expanded=bool(preview)):
+        if preview:
+            st.code(preview, language='xml')
+
+@st.cache_data(show_spinner=False, max_entries=_RESPONSE_CACHE_SIZE, ttl=_RESPONSE_CACHE_TTL)
+def _render_html(animated_svg):
+    """
+    Wraps the animated SVG in the HTML document shown in the preview iframe.
+    Memoized on the SVG text, so reruns with the same result skip the string assembly.
+    """
+    # We add CSS to ensure the SVG does not overflow its container.
+    return f"""
+    <div style="border: 1px solid #ccc; border-radius: 8px; padding: 20px; text-align: center; background-color: #f9f9f9;">
+        <div style="max-width: 100%; height: auto;">
+            {animated_svg}
+        </div>
+    </div>
+    """
 
 
 # --- Streamlit App UI ---
@@ -208,8 +854,21 @@ with col1:
         help="Describe the desired personality or a short story."
     )
 
-    # Button to start the process
-    animate_button = st.button("✨ Animate SVG", type="primary", use_container_width=True)
+    variants_input = st.slider(
+        "How many variants should be generated?",
+        min_value=1,
+        max_value=_MAX_VARIANTS,
+        value=1,
+        help="All variants are generated in a single request. Each one is shown in its own tab."
+    )
+
+    # Button to start the process (disabled while an animation is being generated)
+    job = st.session_state.get("job")
+    job_running = job is not None and not job["future"].done()
+    animate_button = st.button(
+        "✨ Animate SVG", type="primary", use_container_width=True,
+        disabled=job_running
+    )
 
 with col2:
     st.header("2. Result")
@@ -220,43 +879,74 @@ with col2:
     result_placeholder.info("The result will be shown here after you click 'Animate SVG'.")
 
 # --- Logic ---
-if animate_button:
+# Only the progress fragment reruns while a job is running, so a click from a button that was
+# drawn before the job started must not replace (and orphan) the running job
+if animate_button and not job_running:
     # Check if all inputs are provided
     if not svg_code_input or not description_input or not animation_input:
         st.warning("Please fill in all fields to continue.")
+    elif not _credentials_configured():
+        st.error("Error: Azure OpenAI credentials are not configured. Please set the variables in the code or use environment variables.")
     else:
-        with st.spinner("The AI is getting creative and bringing your SVG to life... This might take a moment."):
-            # API call
-            animated_svg_result = get_animated_svg(svg_code_input, description_input, animation_input)
-
-        if animated_svg_result and animated_svg_result.strip().startswith('<svg'):
-            st.success("Animation created successfully!")
-
-            # Display the animated SVG
-            # We add CSS to ensure the SVG does not overflow its container.
-            display_html = f"""
-            <div style="border: 1px solid #ccc; border-radius: 8px; padding: 20px; text-align: center; background-color: #f9f9f9;">
-                <div style="max-width: 100%; height: auto;">
-                    {animated_svg_result}
-                </div>
-            </div>
-            """
-            result_placeholder.markdown(display_html, unsafe_allow_html=True)
+        # The API call runs in the background, so the input pane stays usable meanwhile
+        st.session_state["job"] = _start_job(svg_code_input, description_input, animation_input, variants_input)
+        st.rerun() # Redraw the button as disabled
+
+job = st.session_state.get("job")
+if job is not None and job["future"].done():
+    del st.session_state["job"]
+    try:
+        animated_svg_results, rejected_results, semantic_entry = job["future"].result()
+    except Exception as e:
+        st.error(f"An error occurred with the API request: {e}")
+        animated_svg_results, rejected_results, semantic_entry = [], [], None
+    if semantic_entry is not None:
+        _semantic_cache_store(semantic_entry)
+
+    if animated_svg_results:
+        st.success("Animation created successfully!")
+        if rejected_results:
+            st.warning(f"{len(rejected_results)} of the variants did not contain a valid SVG and were skipped.")
+        st.session_state["animated_svgs"] = animated_svg_results
+    else:
+        # Error handling if the API does not return a valid SVG
+        st.session_state.pop("animated_svgs", None)
+        result_placeholder.error("Could not create a valid SVG animation. Please try a different description or check your original SVG code.")
+        for rejected_result in rejected_results:
+            if rejected_result:
+                st.code(rejected_result, language='text')
+elif job is not None:
+    with result_placeholder.container():
+        _show_job_progress(job)
+
+# Show the latest animation. It is kept in the session state so that it survives reruns
+# triggered by other widgets (e.g. the download button); re-sending the unchanged HTML
+# lets the browser keep the existing iframe instead of rebuilding it.
+animated_svgs = st.session_state.get("animated_svgs")
+if animated_svgs and "job" not in st.session_state:
+    # A single animation fills the result area; several variants get one tab each
+    if len(animated_svgs) == 1:
+        result_targets = [result_placeholder.container()]
+    else:
+        result_targets = result_placeholder.container().tabs(
+            [f"Variant {number}" for number in range(1, len(animated_svgs) + 1)]
+        )
+
+    for index, (result_target, animated_svg_result) in enumerate(zip(result_targets, animated_svgs)):
+        with result_target:
+            # Display the animated SVG in a sandboxed iframe, outside the Markdown pipeline
+            components.html(_render_html(animated_svg_result), height=_PREVIEW_HEIGHT, scrolling=True)
 
             # Download button for the animated SVG
             st.download_button(
                 label="⬇️ Download Animated SVG",
                 data=animated_svg_result.encode('utf-8'),
-                file_name="animated_graphic.svg",
+                file_name=f"animated_graphic_{index + 1}.svg" if len(animated_svgs) > 1 else "animated_graphic.svg",
                 mime="image/svg+xml",
-                use_container_width=True
+                use_container_width=True,
+                key=f"download_{index}"
             )
 
             # Expander to show the generated code
             with st.expander("Show Generated SVG Code"):
                 st.code(animated_svg_result, language='xml')
-        else:
-            # Error handling if the API does not return a valid SVG
-            result_placeholder.error("Could not create a valid SVG animation. Please try a different description or check your original SVG code.")
-            if animated_svg_result:
-                st.code(animated_svg_result, language='text')